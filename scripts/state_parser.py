@@ -1,28 +1,48 @@
+import asyncio
 import boto3
 import configparser
+import functools
 import logging
 import re
 import os
-from jinja2 import Environment, FileSystemLoader
-from subprocess import Popen, PIPE, STDOUT
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from types import SimpleNamespace
+
+
+TERRAFORM_BIN = '/usr/local/bin/terraform'
+
+_TFSTATE_RE = re.compile(r'\.tfstate$')
+
+_JINJA_CACHE_DIR = '.jinja_cache'
+os.makedirs(_JINJA_CACHE_DIR, exist_ok=True)
+
+_JINJA_ENV = Environment(
+    loader=FileSystemLoader('templates'),
+    auto_reload=False,
+    bytecode_cache=FileSystemBytecodeCache(_JINJA_CACHE_DIR))
+_BACKEND_TEMPLATE = _JINJA_ENV.get_template('backend.j2')
 
 
 class EnvironmentMetadata:
   def __init__(self, name, res_class_metadatas):
     self.name = name
     self.res_class_metadatas = res_class_metadatas
-    self.output_path = "./generated/" + name + "/"
+    self.output_path = f"./generated/{name}/"
 
 
+@dataclass(slots=True)
 class ResClassMetadata:
-  def __init__(self, state_file_name, environment_path):
-    self.state_file_name = state_file_name
-    
-    remove_suffix = re.sub('\.tfstate$', '', state_file_name)
-    self.name = (remove_suffix.split('-', 2)[2])
+  state_file_name: str
+  environment_path: str
+  name: str = field(init=False)
+  directory: str = field(init=False)
 
-    self.directory = environment_path + self.name + "/"
+  def __post_init__(self):
+    remove_suffix = _TFSTATE_RE.sub('', self.state_file_name)
+    self.name = remove_suffix.split('-', 2)[2]
+    self.directory = f"{self.environment_path}{self.name}/"
 
 
 class DeployEnvironment:
@@ -49,7 +69,7 @@ def configure_logging(logging_level):
     logging.basicConfig(
         filename='state_parser.log',
         filemode='w',
-        level=logging_level)
+        level=logging.getLevelName(logging_level.upper()))
 
     console = logging.StreamHandler()
     console.setLevel(logging.INFO)
@@ -60,215 +80,176 @@ def configure_logging(logging_level):
     logging.getLogger('').addHandler(console)
 
 
-def parse_bucket_objects(bucket_name, search_string):
+def parse_bucket_objects(paginator, bucket_name, search_string):
     """
-    Returns a list of bucket objects that match a given string.
+    Yields bucket object keys that match a given string.
 
       Parameters:
+        paginator (Paginator): a list_objects_v2 paginator.
         bucket_name (str): canonical name of s3 bucket.
         search_string (str): string to match objects with.
 
-      Returns:
-        matching_objects (list): list of matching object keys.
+      Yields:
+        key (str): matching object key, one page at a time.
     """
-    matching_objects = list()
-    regex_pattern = r"^" + re.escape(search_string)
+    matched_keys = 0
 
-    for bucket_object in bucket_name.objects.all():
-        if re.match(regex_pattern, bucket_object.key):
-            matching_objects.append(bucket_object.key)
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=search_string):
+        for bucket_object in page.get('Contents', []):
+            matched_keys += 1
+            yield bucket_object['Key']
 
-    return matching_objects
+    logging.info("Matched %d keys for prefix: %s", matched_keys, search_string)
 
 
-# def parse_res_classes(state_file):
-#     """
-#     Returns a list of res_classes, by taking the state file name and stripping
-#     out the res_class.
+def _render_backend_file(bucket_name, res_class_metadata, aws_region):
+    output_uri = f"{res_class_metadata.directory}backend.tf"
 
-#       Parameters:
-#         state_file (list): a list of state file names.
+    rendered = _BACKEND_TEMPLATE.render(
+        bucket=bucket_name,
+        key=res_class_metadata.state_file_name,
+        region=aws_region)
 
-#       Returns:
-#         res_class_name (str): list of res_class names.
-#     """
-#     remove_suffix = re.sub('\.tfstate$', '', state_file)
-#     res_class_name = (remove_suffix.split('-', 2)[2])
+    with open(output_uri, 'w') as backend_file:
+        backend_file.write(rendered)
 
-#     return res_class_name
+    logging.info("Generated file: '%s'", output_uri)
 
 
 def generate_backend_file(bucket_name, state_file_list, aws_region, output_path):
-    file_loader = FileSystemLoader('templates')
-    env = Environment(loader=file_loader)
-
-    template = env.get_template('backend.j2')
-
-    res_class_metadatas = []
-
-    for state_file_name in state_file_list:
-        res_class_metadata = ResClassMetadata(state_file_name, output_path)
-        output_file_name = "backend.tf"
-        output_uri = res_class_metadata.directory + output_file_name
+    res_class_metadatas = [
+        ResClassMetadata(state_file_name, output_path)
+        for state_file_name in state_file_list]
 
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+    for directory in {m.directory for m in res_class_metadatas}:
+        os.makedirs(directory, exist_ok=True)
 
-        template.stream(
-            bucket=bucket_name,
-            key=res_class_metadata.state_file_name,
-            region=aws_region).dump(output_uri)
-
-        logging.info("Generated file: '{}'".format(output_uri))
-
-        res_class_metadatas.append(res_class_metadata)
+    if res_class_metadatas:
+        with ThreadPoolExecutor(
+                max_workers=min(32, len(res_class_metadatas))) as executor:
+            list(executor.map(
+                lambda metadata: _render_backend_file(
+                    bucket_name, metadata, aws_region),
+                res_class_metadatas))
 
     return res_class_metadatas
 
 
 
-def pull_state_file(res_class_dirs):
-    multiprocessing_processes = len(res_class_dirs)
-
-    logging.info("Number of processes: {}".format(multiprocessing_processes))
-    logging.info("Res_class dirs: {}".format(res_class_dirs))
-
-    with Pool(multiprocessing_processes) as pool:
-        processed = pool.map(state_pull_subprocess, res_class_dirs)
+async def _gather_subprocesses(subprocess_coroutine, res_class_dirs):
+    await asyncio.gather(
+        *(subprocess_coroutine(working_directory)
+          for working_directory in res_class_dirs))
 
 
-def state_pull_subprocess(value):
-    process = ['/usr/local/bin/terraform', 'state', 'pull']
-    working_directory = value
-
-    logging.info("Pulling state: {}".format(working_directory))
+async def state_pull_subprocess(working_directory):
+    logging.info("Pulling state: %s", working_directory)
     with open(working_directory + '/state.json', 'wb') as state_file:
-      proc = Popen(
-          process,
-          bufsize=8192,
-          stdin=None,
-          stdout=state_file,
-          stderr=STDOUT,
-          cwd=working_directory)
-      
-
-    output = []
-    proc.wait()
-
-    while True:
-
-        proc.poll()
+        proc = await asyncio.create_subprocess_exec(
+            TERRAFORM_BIN, 'state', 'pull',
+            stdin=None,
+            stdout=state_file,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=working_directory)
 
-        stdout, stderr = proc.communicate()
-        if stdout:
-            output.append(stdout.decode('utf-8'))
-        if stderr:
-            output.append(stderr.decode('utf-8'))
+        _, stderr = await proc.communicate()
 
-        if proc.returncode is not None:
-            break
-        time.sleep(0.01)
+    if proc.returncode != 0:
+        raise RuntimeError(
+            "Error pulling terraform state in {}: {}".format(
+                working_directory, stderr.decode(errors='replace')))
 
-        if proc.returncode != 0:
-            raise Exception("Error initializing terraform")
 
-        logging.info(output)
+def init_res_classes(res_class_dirs):
+    logging.info("Res_class dirs: %s", res_class_dirs)
 
+    asyncio.run(_gather_subprocesses(init_and_pull_subprocess, res_class_dirs))
 
-def init_res_classes(output_path):
-    res_class_dirs = list()
 
-    for root, dirs, files in os.walk(output_path, topdown=False):
-        for name in dirs:
-            res_class_dirs.append(os.path.join(root, name))
+async def init_and_pull_subprocess(working_directory):
+    await init_subprocess(working_directory)
+    await state_pull_subprocess(working_directory)
 
-    multiprocessing_processes = len(res_class_dirs)
 
-    logging.info("Number of processes: {}".format(multiprocessing_processes))
-    logging.info("Res_class dirs: {}".format(res_class_dirs))
-
-    with Pool(multiprocessing_processes) as pool:
-        processed = pool.map(init_subprocess, res_class_dirs)
-    
-    pull_state_file(res_class_dirs)
-
-
-
-def init_subprocess(value):
-    process = ['/usr/local/bin/terraform', 'init']
-    working_directory = value
-
-    logging.info("Initialising: {}".format(working_directory))
-    proc = Popen(
-        process,
-        bufsize=8192,
+async def init_subprocess(working_directory):
+    logging.info("Initialising: %s", working_directory)
+    proc = await asyncio.create_subprocess_exec(
+        TERRAFORM_BIN, 'init',
         stdin=None,
-        stdout=PIPE,
-        stderr=STDOUT,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
         cwd=working_directory)
 
-    output = []
-    proc.wait()
+    stdout, _ = await proc.communicate()
 
-    while True:
+    if proc.returncode != 0:
+        raise RuntimeError(
+            "Error initializing terraform: {}".format(
+                stdout.decode(errors='replace')))
 
-        proc.poll()
+    logging.info("%s", stdout.decode(errors='replace'))
 
-        stdout, stderr = proc.communicate()
-        if stdout:
-            output.append(stdout.decode('utf-8'))
-        if stderr:
-            output.append(stderr.decode('utf-8'))
 
-        if proc.returncode is not None:
-            break
-        time.sleep(0.01)
+def parse_state_file(environment_metadata):
+    pass
 
-        if proc.returncode != 0:
-            raise Exception("Error initializing terraform")
 
-        logging.info(output)
+def process_environment(environment, paginator, bucket_name, aws_region):
+    environment_metadata = EnvironmentMetadata(environment, [])
 
+    logging.info("Processing project: %s", environment_metadata.name)
+    state_file_list = parse_bucket_objects(
+        paginator, bucket_name, environment_metadata.name)
 
-def parse_state_file(environment_metadata):
-  
+    logging.info("Beginning generate backend files.")
+    environment_metadata.res_class_metadatas = generate_backend_file(
+        bucket_name,
+        state_file_list,
+        aws_region,
+        environment_metadata.output_path)
 
+    logging.info("Beginning initialise res_classes.")
+    init_res_classes(
+        [metadata.directory
+         for metadata in environment_metadata.res_class_metadatas])
 
-def main():
-    parser = configparser.ConfigParser()
-    parser.read("config.txt")
-
-    aws_region = parser.get("aws", "region")
-    project_environments = parser.get("project", "environments")
-    bucket_name = parser.get("S3", "bucket_name")
-    logging_level = parser.get("logging", "level")
+    parse_state_file(environment_metadata)
 
-    configure_logging(logging_level)
 
-    s3 = boto3.resource('s3')
-    state_bucket = s3.Bucket(bucket_name)
+@functools.lru_cache(maxsize=1)
+def load_config():
+    """
+    Reads config.txt once and caches the parsed settings.
 
-    environments = []
+      Returns:
+        config (SimpleNamespace): region, environments, bucket name and
+        logging level from config.txt.
+    """
+    parser = configparser.ConfigParser()
+    parser.read("config.txt")
 
-    for environment in project_environments.split(','):
+    return SimpleNamespace(
+        aws_region=parser.get("aws", "region"),
+        environments=tuple(
+            environment.strip()
+            for environment in parser.get("project", "environments").split(",")),
+        bucket_name=parser.get("S3", "bucket_name"),
+        logging_level=parser.get("logging", "level"))
 
-      environment_metadata = EnvironmentMetadata(environment, [])      
 
-      logging.info("Processing project: {}".format(environment_metadata.name))
-      state_file_list = list(parse_bucket_objects(state_bucket, environment_metadata.name))
+def main():
+    config = load_config()
 
-      logging.info("Beginning generate backend files.")
-      environment_metadata.res_class_metadatas=generate_backend_file(
-          bucket_name,
-          state_file_list,
-          aws_region,
-          environment_metadata.output_path)
+    configure_logging(config.logging_level)
 
-      logging.info("Beginning initialise res_classes.")
-      init_res_classes(environment_metadata.output_path)
+    s3_client = boto3.client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
 
-      parse_state_file(environment_metadata)
-      
+    with ThreadPoolExecutor(max_workers=len(config.environments)) as executor:
+        list(executor.map(
+            lambda environment: process_environment(
+                environment, paginator, config.bucket_name, config.aws_region),
+            config.environments))
 
 
 if __name__ == "__main__":